@@ -1,5 +1,5 @@
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Request, Form, HTTPException
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import json
@@ -7,13 +7,24 @@ import random
 import os
 import time
 import asyncio
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
 from dotenv import load_dotenv
 import markdown
 import gspread
 from google.oauth2.service_account import Credentials
 from datetime import datetime
 import re
+import hmac
+import hashlib
+import secrets
+import sqlite3
+import threading
+import collections
+import contextlib
+import numpy as np
+import pandas as pd
+import io
+import html
 
 # Load environment variables
 load_dotenv()
@@ -441,6 +452,161 @@ async def save_student_info(student_data):
         print(f"⚠️ Error saving to Google Sheet: {e}")
 
 
+# --- Local Analytics Store ---
+
+ANALYTICS_DB = os.getenv("ANALYTICS_DB", "analytics.db")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # admin endpoints are disabled when empty
+
+# The CCCD (national ID) is deliberately not stored, like in the Google Sheet
+ANALYTICS_COLUMNS = ["created_at", "student_name", "student_phone", "student_email", "student_province",
+                     "student_school", "team", "predicted_major", "sub_major_1",
+                     "sub_major_2", "result_source", "quiz_seconds"]
+
+# Dimensions with pre-aggregated counts per predicted major
+ANALYTICS_GROUPS = ("all", "day", "province", "school", "team")
+
+class AnalyticsStore:
+    """
+    Keep every quiz result in a local SQLite file so statistics do not need the Google Sheet.
+    Counts per major are aggregated on insert, so dashboards only read a small table.
+    """
+
+    def __init__(self, db_path):
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL, student_name TEXT, student_phone TEXT, "
+            "student_email TEXT, student_province TEXT, student_school TEXT, team TEXT, "
+            "predicted_major TEXT, sub_major_1 TEXT, sub_major_2 TEXT, result_source TEXT, quiz_seconds REAL)"
+        )
+        for column in ("created_at", "student_province", "student_school", "team", "predicted_major"):
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS idx_results_{column} ON results ({column})")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS result_counts ("
+            "group_by TEXT, group_value TEXT, predicted_major TEXT, total INTEGER, "
+            "PRIMARY KEY (group_by, group_value, predicted_major))"
+        )
+        self._db.commit()
+
+    def add(self, student_data):
+        """Store one result and update the counts"""
+        created_at = time.time()
+        started_at = student_data.get('quiz_started_at')
+        team = check_school_team(student_data.get('student_school', '')) or ""
+        row = {
+            "created_at": created_at,
+            "team": team,
+            "result_source": student_data.get('result_source', 'ai'),
+            "quiz_seconds": created_at - started_at if started_at else None,
+        }
+        for column in ANALYTICS_COLUMNS:
+            if column not in row:
+                row[column] = student_data.get(column, '')
+
+        major = row["predicted_major"]
+        groups = {
+            "all": "",
+            "day": datetime.fromtimestamp(created_at).strftime("%Y-%m-%d"),
+            "province": row["student_province"],
+            "school": row["student_school"],
+            "team": team,
+        }
+
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    f"INSERT INTO results ({', '.join(ANALYTICS_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in ANALYTICS_COLUMNS)})",
+                    [row[column] for column in ANALYTICS_COLUMNS]
+                )
+                self._db.executemany(
+                    "INSERT INTO result_counts VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT (group_by, group_value, predicted_major) DO UPDATE SET total = total + 1",
+                    [(group_by, group_value, major) for group_by, group_value in groups.items()]
+                )
+
+    def counts(self, group_by):
+        """Pre-aggregated result counts per major for one of ANALYTICS_GROUPS"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT group_value, predicted_major, total FROM result_counts "
+                "WHERE group_by = ? ORDER BY group_value, total DESC", (group_by,)
+            ).fetchall()
+        return [{"group": g, "predicted_major": m, "total": t} for g, m, t in rows]
+
+    @staticmethod
+    def where_clause(filters):
+        """SQL WHERE clause for the export filters (since/until are YYYY-MM-DD)"""
+        clauses = []
+        params = []
+        for column, value in filters.items():
+            if not value:
+                continue
+            if column == "since":
+                clauses.append("created_at >= ?")
+                params.append(datetime.strptime(value, "%Y-%m-%d").timestamp())
+            elif column == "until":
+                clauses.append("created_at < ?")
+                params.append(datetime.strptime(value, "%Y-%m-%d").timestamp() + 86400)
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    @staticmethod
+    def _local_times(timestamps):
+        """Unix timestamps as server-local datetimes, the same time the day counts and filters use"""
+        local_tz = datetime.now().astimezone().tzinfo
+        return pd.to_datetime(timestamps, unit="s", utc=True).dt.tz_convert(local_tz)
+
+    def _read_sql(self, filters, chunksize=None):
+        where, params = self.where_clause(filters)
+        # Separate read-only connection so long exports do not block new results
+        conn = sqlite3.connect(self._db_path, check_same_thread=False)
+        query = f"SELECT {', '.join(ANALYTICS_COLUMNS)} FROM results{where} ORDER BY id"
+        return conn, pd.read_sql_query(query, conn, params=params, chunksize=chunksize)
+
+    def iter_csv(self, filters, chunksize=5000):
+        """Yield the results as CSV text, one chunk at a time"""
+        conn, chunks = self._read_sql(filters, chunksize)
+        try:
+            first = True
+            for chunk in chunks:
+                chunk["created_at"] = self._local_times(chunk["created_at"])
+                yield chunk.to_csv(index=False, header=first)
+                first = False
+            if first:
+                yield ",".join(ANALYTICS_COLUMNS) + "\n"
+        finally:
+            conn.close()
+
+    def to_parquet(self, filters):
+        """All matching results as Parquet bytes (needs pyarrow or fastparquet)"""
+        conn, df = self._read_sql(filters)
+        conn.close()
+        df["created_at"] = self._local_times(df["created_at"])
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+analytics_store = None
+try:
+    analytics_store = AnalyticsStore(ANALYTICS_DB)
+except sqlite3.Error as e:
+    print(f"⚠️ Error opening analytics database '{ANALYTICS_DB}': {e}")
+
+async def save_analytics(student_data):
+    """Save result to the local analytics store"""
+    if not analytics_store:
+        return
+    try:
+        await asyncio.to_thread(analytics_store.add, student_data)
+    except Exception as e:
+        print(f"⚠️ Error saving to analytics store: {e}")
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -470,11 +636,201 @@ def load_system_prompt():
     except FileNotFoundError:
         return "Bạn là một chuyên gia tư vấn hướng nghiệp."
 
-async def generate_ai_advice(user_answers_text):
+# --- Local Major Scoring ---
+
+LOCAL_SCORING_HINT = os.getenv("LOCAL_SCORING_HINT", "0") == "1"  # add the local top majors to the AI prompt
+
+SCORING_TRAITS = ("tech", "hands_on", "logic", "research", "creative", "social",
+                  "leader", "business", "detail", "expression")
+
+# Every question is "how much does this describe you": A = strongly yes ... D = no
+OPTION_INTENSITY = {"A": 1.0, "B": 0.5, "C": 0.0, "D": -0.5}
+
+# A major needs at least this score before it is offered as a fallback result
+MIN_LOCAL_SCORE = 0.1
+
+# Which traits a "yes" to each question signals
+QUESTION_TRAITS = {
+    1: {"hands_on": 1.0},
+    2: {"research": 0.7, "tech": 0.6},
+    3: {"creative": 1.0},
+    4: {"social": 1.0},
+    5: {"leader": 1.0},
+    6: {"detail": 0.8},
+    7: {"hands_on": 1.0},
+    8: {"logic": 1.0},
+    9: {"creative": 0.8, "expression": 0.3},
+    10: {"social": 1.0},
+    11: {"business": 1.0},
+    12: {"detail": 0.6, "business": 0.5},
+    13: {"hands_on": 0.4, "social": 0.3},
+    14: {"logic": 0.7, "research": 0.5},
+    15: {"expression": 0.8, "creative": 0.4},
+    16: {"social": 0.6, "expression": 0.5},
+    17: {"expression": 1.0, "leader": 0.3},
+    18: {"detail": 1.0},
+    19: {"creative": 0.6, "hands_on": 0.5},
+    20: {"logic": 1.0},
+    21: {"creative": 0.6, "business": 0.3},
+    22: {"social": 1.0},
+    23: {"business": 0.8, "leader": 0.6},
+    24: {"detail": 0.8},
+    25: {"hands_on": 0.6},
+    26: {"tech": 1.0},
+    27: {"creative": 1.0},
+    28: {"social": 0.6},
+    29: {"business": 0.5, "leader": 0.5},
+    30: {"detail": 0.5},
+    31: {"hands_on": 0.6, "research": 0.3},
+    32: {"research": 1.0, "hands_on": 0.3},
+    33: {"creative": 0.5, "business": 0.5, "expression": 0.5},
+    34: {"social": 1.0},
+    35: {"leader": 1.0},
+    36: {"research": 0.5, "detail": 0.3},
+    37: {"hands_on": 1.0},
+    38: {"research": 0.7, "expression": 0.3},
+    39: {"creative": 0.4},
+    40: {"social": 0.4, "leader": 0.4},
+    41: {"expression": 0.7, "leader": 0.4},
+    42: {"detail": 1.0},
+    43: {"business": 0.4},
+    44: {"research": 0.6, "expression": 0.4},
+    45: {"creative": 0.3, "social": 0.3},
+}
+
+# Trait profile of each major, keyed by the Vietnamese name used in System_prompt.txt.
+# Majors of the same block lead with different traits so they do not split the same answers.
+MAJOR_TRAITS = {
+    "Kỹ thuật phần mềm": {"tech": 1.0, "logic": 0.7},
+    "Trí tuệ nhân tạo": {"research": 1.0, "logic": 0.7, "tech": 0.4},
+    "An toàn thông tin": {"detail": 0.9, "tech": 0.7, "logic": 0.3},
+    "Thiết kế mỹ thuật số": {"creative": 1.0, "tech": 0.3},
+    "Thiết kế vi mạch bán dẫn": {"hands_on": 0.8, "logic": 0.6, "research": 0.4},
+    "Công nghệ ô tô số": {"hands_on": 1.0, "tech": 0.6, "detail": 0.3},
+    "Truyền thông đa phương tiện": {"expression": 0.8, "creative": 0.7},
+    "Digital Marketing": {"business": 0.8, "creative": 0.7},
+    "Kinh doanh quốc tế": {"business": 1.0, "expression": 0.7},
+    "Quản trị kinh doanh": {"leader": 1.0, "business": 0.5},
+    "Quản trị khách sạn": {"social": 1.0, "leader": 0.5, "business": 0.5},
+    "Logistics và Quản lý chuỗi cung ứng": {"detail": 0.8, "business": 0.7},
+    "Ngôn ngữ Anh": {"expression": 1.0, "leader": 0.3},
+    "Ngôn ngữ Nhật": {"expression": 0.7, "detail": 0.7},
+    "Ngôn ngữ Trung Quốc": {"expression": 0.6, "social": 0.6, "business": 0.3},
+    "Luật Kinh tế": {"expression": 0.7, "research": 0.6, "logic": 0.3},
+}
+
+def load_allowed_majors():
+    """Read the allowed major list (section II) from System_prompt.txt"""
+    prompt = load_system_prompt()
+    match = re.search(r"## II\..*?\n(.*?)\n## III\.", prompt, re.DOTALL)
+    if not match:
+        return []
+    return re.findall(r"^\s*\*\s+(.+?)\s*$", match.group(1), re.MULTILINE)
+
+class MajorScoringEngine:
+    """
+    Score quiz answers against the allowed majors without calling the AI.
+    affinity[question, major] is precomputed. A submission is scored by centering
+    the student's answers on their own average (so answering everything the same
+    says nothing) and dividing by how much the asked questions tell about each
+    major (so majors with many related questions do not win by default).
+    """
+
+    def __init__(self, questions, majors):
+        self.majors = []
+        major_rows = []
+        for name in majors:
+            profile = MAJOR_TRAITS.get(name.split(" (")[0].strip())
+            if profile is None:
+                print(f"⚠️ Warning: no scoring profile for major '{name}'")
+                continue
+            self.majors.append(name)
+            major_rows.append([profile.get(trait, 0.0) for trait in SCORING_TRAITS])
+
+        self._question_index = {}
+        question_rows = []
+        for q in questions:
+            traits = QUESTION_TRAITS.get(q['id'], {})
+            self._question_index[str(q['id'])] = len(question_rows)
+            question_rows.append([traits.get(trait, 0.0) for trait in SCORING_TRAITS])
+
+        self._option_index = {key: i for i, key in enumerate(OPTION_INTENSITY)}
+        intensity = np.array(list(OPTION_INTENSITY.values()), dtype=np.float32)
+
+        major_matrix = np.array(major_rows, dtype=np.float32).reshape(-1, len(SCORING_TRAITS))
+        # Normalize so majors with more traits do not win by default
+        major_matrix /= np.maximum(np.linalg.norm(major_matrix, axis=1, keepdims=True), 1e-6)
+        question_matrix = np.array(question_rows, dtype=np.float32).reshape(-1, len(SCORING_TRAITS))
+
+        self._intensity = intensity
+        self.affinity = question_matrix @ major_matrix.T  # (questions, majors)
+
+    def score(self, answers):
+        """Score of every major for a {question_id: option_key} mapping"""
+        q_idx = []
+        o_idx = []
+        for q_id, key in answers.items():
+            if q_id in self._question_index and key in self._option_index:
+                q_idx.append(self._question_index[q_id])
+                o_idx.append(self._option_index[key])
+        if not q_idx:
+            return np.zeros(len(self.majors), dtype=np.float32)
+
+        answered = self.affinity[q_idx]  # (answered questions, majors)
+        intensity = self._intensity[o_idx]
+        centered = intensity - intensity.mean()
+        # Same spread for every major on random answers; the floor keeps unrelated majors near 0
+        evidence = np.maximum(np.sqrt((answered ** 2).sum(axis=0)), 0.2)
+        return (centered @ answered) / evidence
+
+    def top_majors(self, answers, k=3):
+        """The k best matching majors as (name, score), best first; [] if no major stands out"""
+        scores = self.score(answers)
+        if scores.size == 0 or scores.max() < MIN_LOCAL_SCORE:
+            return []
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [(self.majors[i], float(scores[i])) for i in best]
+
+_scoring_engine = None
+
+def get_scoring_engine():
+    """Build the scoring engine on first use"""
+    global _scoring_engine
+    if _scoring_engine is None:
+        _scoring_engine = MajorScoringEngine(load_questions(), load_allowed_majors())
+    return _scoring_engine
+
+def build_fallback_advice(top_majors):
+    """Advice in the AI output format, built from the local scores when the AI is unavailable"""
+    main_major = top_majors[0][0]
+    sub_majors = [name for name, _ in top_majors[1:3]]
+    lines = [
+        "### 📡 BÁO CÁO GIẢI MÃ TÍN HIỆU VŨ TRỤ",
+        "**Trạng thái:** *Chuyên gia AI tạm thời chưa phản hồi được, kết quả dưới đây được hệ thống chấm điểm nội bộ tính nhanh từ câu trả lời của bạn.*",
+        "",
+        f"### 1. 🌌 KẾT QUẢ ĐỊNH VỊ: {main_major}",
+        "",
+        "### 5. 🎯 GỢI Ý 2 NGÀNH HỌC PHỤ",
+        "Ngoài ngành chính, đây là 2 ngành học phụ cũng rất phù hợp với bạn:",
+        "",
+    ]
+    for i, name in enumerate(sub_majors, start=1):
+        lines.append(f"* **🔸 Ngành học phụ #{i}: {name}**")
+        lines.append("")
+    lines.append("---")
+    lines.append("*Bạn có thể làm lại bài trắc nghiệm sau ít phút để nhận phân tích chi tiết từ Chuyên gia AI.*")
+    return "\n".join(lines)
+
+async def generate_ai_advice(user_answers_text, deadline=None, hint=None):
     """
     Call AI to generate advice using OpenRouter.
+    deadline is a time.monotonic() value after which no more retries are made.
+    hint is an optional note (e.g. local top majors) appended to the user message.
     """
     system_prompt = await asyncio.to_thread(load_system_prompt)
+    user_content = f"[CÂU TRẢ LỜI CỦA HỌC SINH]\n{user_answers_text}\n\nLưu ý: Hãy trả lời hoàn toàn bằng Tiếng Việt. Đảm bảo phản hồi đầy đủ cả 4 phần trong định dạng đầu ra."
+    if hint:
+        user_content += f"\n\n[GỢI Ý TỪ HỆ THỐNG CHẤM ĐIỂM NỘI BỘ]\n{hint}"
     
     # Get API Key
     api_key = os.getenv("OPENROUTER_API_KEY")
@@ -490,7 +846,8 @@ async def generate_ai_advice(user_answers_text):
             default_headers={
                 "HTTP-Referer": "http://localhost:5000",
                 "X-Title": "FPTU Career Chatbot",
-            }
+            },
+            max_retries=0  # retries (incl. connection errors and 5xx) are handled below
         )
         
         max_retries = 5
@@ -498,7 +855,7 @@ async def generate_ai_advice(user_answers_text):
 
         for attempt in range(max_retries):
             try:
-                completion = await client.chat.completions.create(
+                call = client.chat.completions.create(
                     model="arcee-ai/trinity-large-preview:free", 
                     messages=[
                         {
@@ -507,7 +864,7 @@ async def generate_ai_advice(user_answers_text):
                         },
                         {
                             "role": "user",
-                            "content": f"[CÂU TRẢ LỜI CỦA HỌC SINH]\n{user_answers_text}\n\nLưu ý: Hãy trả lời hoàn toàn bằng Tiếng Việt. Đảm bảo phản hồi đầy đủ cả 4 phần trong định dạng đầu ra."
+                            "content": user_content
                         }
                     ],
                     temperature=0.7,
@@ -517,10 +874,25 @@ async def generate_ai_advice(user_answers_text):
                         "repetition_penalty": 1.1
                     }
                 )
+                if deadline is None:
+                    completion = await call
+                else:
+                    # Bound the call itself, not only the pauses between retries
+                    try:
+                        completion = await asyncio.wait_for(call, max(1, deadline - time.monotonic()))
+                    except asyncio.TimeoutError:
+                        raise TimeoutError("OpenRouter did not answer before the request deadline") from None
                 return completion.choices[0].message.content
             except Exception as e:
                 print(f"Attempt {attempt+1} failed: {e}") # Log lỗi ra terminal
-                if ("429" in str(e) or "400" in str(e)) and attempt < max_retries - 1:
+                # Rate limits, connection problems/timeouts and server errors are worth another try
+                retryable = (
+                    "429" in str(e) or "400" in str(e)
+                    or isinstance(e, APIConnectionError)
+                    or (isinstance(e, APIStatusError) and (e.status_code in (408, 409) or e.status_code >= 500))
+                )
+                out_of_time = deadline is not None and time.monotonic() + retry_delay >= deadline
+                if retryable and attempt < max_retries - 1 and not out_of_time:
                     await asyncio.sleep(retry_delay)
                     retry_delay *= 2  # Exponential backoff
                     continue
@@ -529,6 +901,380 @@ async def generate_ai_advice(user_answers_text):
     except Exception as e:
         return f"⚠️ **Đã xảy ra lỗi khi gọi OpenRouter AI:**\n\n{str(e)}"
 
+# --- Quiz Session Store ---
+
+QUIZ_SESSION_SECRET = os.getenv("QUIZ_SESSION_SECRET") or secrets.token_hex(32)
+QUIZ_SESSION_TTL = int(os.getenv("QUIZ_SESSION_TTL", "7200"))  # seconds
+QUIZ_SESSION_DB = os.getenv("QUIZ_SESSION_DB", "")  # optional SQLite file, empty = memory only
+
+class QuizSession:
+    """One quiz attempt: the questions shown to the student and who they are."""
+    __slots__ = ("session_id", "question_ids", "question_texts", "student_info", "created_at", "submitted_at")
+
+    def __init__(self, session_id, question_ids, question_texts, student_info, created_at, submitted_at=None):
+        self.session_id = session_id
+        self.question_ids = question_ids
+        self.question_texts = question_texts
+        self.student_info = student_info
+        self.created_at = created_at
+        self.submitted_at = submitted_at
+
+    def answers(self, form_data):
+        """Chosen option key for each answered question, keyed by question id"""
+        return {q_id: form_data[f"q_{q_id}"] for q_id in self.question_ids if form_data.get(f"q_{q_id}")}
+
+    def build_answers_text(self, form_data):
+        """Build the answers block for the AI from the precomputed question texts"""
+        lines = []
+        for q_id, q_text in zip(self.question_ids, self.question_texts):
+            value = form_data.get(f"q_{q_id}")
+            if value:
+                lines.append(f"- {q_text}: {value}\n")
+        return "".join(lines)
+
+class QuizSessionStore:
+    """
+    Keep quiz sessions on the server, keyed by a signed token.
+    Sessions live in memory; if db_path is set they are also written to SQLite
+    so they survive a restart.
+    """
+
+    def __init__(self, secret, ttl, db_path=""):
+        self._secret = secret.encode("utf-8")
+        self._ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+        self._db = None
+
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS quiz_sessions ("
+                    "session_id TEXT PRIMARY KEY, question_ids TEXT, question_texts TEXT, "
+                    "student_info TEXT, created_at REAL, submitted_at REAL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Error opening quiz session database '{db_path}': {e}")
+                self._db = None
+
+    def _sign(self, session_id):
+        return hmac.new(self._secret, session_id.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+    def _unsign(self, token):
+        """Return the session id if the token signature is valid, else None"""
+        session_id, _, signature = str(token).rpartition(".")
+        if not session_id or not hmac.compare_digest(signature, self._sign(session_id)):
+            return None
+        return session_id
+
+    def create(self, questions, student_info):
+        """Register a new quiz attempt and return its signed token"""
+        session = QuizSession(
+            session_id=secrets.token_urlsafe(16),
+            question_ids=tuple(str(q['id']) for q in questions),
+            question_texts=tuple(q['content'] for q in questions),
+            student_info=dict(student_info),
+            created_at=time.time()
+        )
+
+        with self._lock:
+            self._sessions[session.session_id] = session
+            if self._db:
+                self._db.execute(
+                    "INSERT INTO quiz_sessions VALUES (?, ?, ?, ?, ?, NULL)",
+                    (session.session_id, json.dumps(session.question_ids),
+                     json.dumps(session.question_texts, ensure_ascii=False),
+                     json.dumps(session.student_info, ensure_ascii=False), session.created_at)
+                )
+                self._db.commit()
+            if session.created_at - self._last_purge > 60:
+                self._purge_expired(session.created_at)
+
+        return f"{session.session_id}.{self._sign(session.session_id)}"
+
+    def get(self, token):
+        """Return the session for a token, or None if it is invalid or expired"""
+        session_id = self._unsign(token)
+        if not session_id:
+            return None
+
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None and self._db:
+                row = self._db.execute(
+                    "SELECT session_id, question_ids, question_texts, student_info, created_at, submitted_at "
+                    "FROM quiz_sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if row:
+                    session = QuizSession(row[0], tuple(json.loads(row[1])), tuple(json.loads(row[2])),
+                                          json.loads(row[3]), row[4], row[5])
+                    self._sessions[session_id] = session
+
+        if session is None or time.time() - session.created_at > self._ttl:
+            return None
+        return session
+
+    def mark_submitted(self, session):
+        """
+        Mark a session as submitted. Returns False if it was already submitted.
+        With a database the check is a single conditional UPDATE, so workers
+        sharing the file cannot both accept the same session.
+        """
+        now = time.time()
+        with self._lock:
+            if self._db:
+                cursor = self._db.execute(
+                    "UPDATE quiz_sessions SET submitted_at = ? WHERE session_id = ? AND submitted_at IS NULL",
+                    (now, session.session_id)
+                )
+                self._db.commit()
+                if cursor.rowcount != 1:
+                    return False
+            elif session.submitted_at is not None:
+                return False
+            session.submitted_at = now
+        return True
+
+    def reopen(self, session):
+        """Allow a session to be submitted again, e.g. after it was turned away"""
+        with self._lock:
+            session.submitted_at = None
+            if self._db:
+                self._db.execute("UPDATE quiz_sessions SET submitted_at = NULL WHERE session_id = ?",
+                                 (session.session_id,))
+                self._db.commit()
+
+    def _purge_expired(self, now):
+        """Drop expired sessions. Caller must hold the lock."""
+        cutoff = now - self._ttl
+        expired = [sid for sid, s in self._sessions.items() if s.created_at < cutoff]
+        for sid in expired:
+            del self._sessions[sid]
+        if self._db:
+            self._db.execute("DELETE FROM quiz_sessions WHERE created_at < ?", (cutoff,))
+            self._db.commit()
+        self._last_purge = now
+
+if not os.getenv("QUIZ_SESSION_SECRET"):
+    print("⚠️ Warning: 'QUIZ_SESSION_SECRET' not set. Quizzes in progress will be lost on restart "
+          "and sessions only work with a single worker.")
+elif not QUIZ_SESSION_DB:
+    print("⚠️ Warning: 'QUIZ_SESSION_DB' not set. Quiz sessions are kept in memory only "
+          "(lost on restart, single worker only).")
+
+quiz_sessions = QuizSessionStore(QUIZ_SESSION_SECRET, QUIZ_SESSION_TTL, QUIZ_SESSION_DB)
+
+# --- Duplicate Submission Detection ---
+
+SUBMISSION_DEDUP_WINDOW = int(os.getenv("SUBMISSION_DEDUP_WINDOW", "1800"))  # seconds
+
+class SubmissionRecord:
+    """A submission that is being processed or already has a result."""
+    __slots__ = ("keys", "created_at", "result")
+
+    def __init__(self, keys, created_at):
+        self.keys = keys
+        self.created_at = created_at
+        self.result = asyncio.get_running_loop().create_future()
+
+    async def wait(self):
+        """Return the advice HTML of this submission, or None if it failed"""
+        try:
+            return await asyncio.shield(self.result)
+        except asyncio.CancelledError:
+            if self.result.cancelled():
+                return None
+            raise
+
+class SubmissionDeduplicator:
+    """
+    Index of recent submissions keyed by student identity (phone, email, CCCD)
+    plus a fingerprint of the answers. Used only from the event loop thread.
+    """
+
+    def __init__(self, window):
+        self._window = window
+        self._index = {}
+        self._last_purge = time.time()
+
+    @staticmethod
+    def identity_keys(student_info):
+        """Normalized phone, email and CCCD of a student"""
+        keys = []
+        phone = re.sub(r"\D", "", student_info.get('student_phone', ''))
+        if phone.startswith("84") and len(phone) == 11:
+            phone = "0" + phone[2:]
+        if phone:
+            keys.append(f"phone:{phone}")
+        email = student_info.get('student_email', '').strip().lower()
+        if email:
+            keys.append(f"email:{email}")
+        cccd = re.sub(r"\D", "", student_info.get('student_cccd', ''))
+        if cccd:
+            keys.append(f"cccd:{cccd}")
+        return keys
+
+    @staticmethod
+    def answers_fingerprint(question_ids, form_data):
+        """Stable hash of the chosen options for the given questions"""
+        answers = "|".join(f"{q_id}={form_data.get(f'q_{q_id}', '')}" for q_id in sorted(question_ids))
+        return hashlib.sha256(answers.encode("utf-8")).hexdigest()[:16]
+
+    def keys_for(self, session_id, student_info, question_ids, form_data):
+        """Dedup keys for a submission; the session id covers students with no contact info"""
+        fingerprint = self.answers_fingerprint(question_ids, form_data)
+        keys = [f"session:{session_id}"] + self.identity_keys(student_info)
+        return tuple(f"{key}#{fingerprint}" for key in keys)
+
+    def find(self, keys):
+        """Return the recent submission matching any of the keys, or None"""
+        now = time.time()
+        if now - self._last_purge > 60:
+            self._purge_expired(now)
+
+        for key in keys:
+            record = self._index.get(key)
+            if record is not None and now - record.created_at <= self._window:
+                return record
+        return None
+
+    def begin(self, keys):
+        """Register a new submission so later duplicates can wait for its result"""
+        record = SubmissionRecord(keys, time.time())
+        for key in keys:
+            self._index[key] = record
+        return record
+
+    def complete(self, record, advice_html, keep=True):
+        """Publish the result to waiting duplicates; keep=False forgets the submission"""
+        if not record.result.done():
+            record.result.set_result(advice_html)
+        if not keep:
+            self.discard(record)
+
+    def discard(self, record):
+        for key in record.keys:
+            if self._index.get(key) is record:
+                del self._index[key]
+        if not record.result.done():
+            record.result.cancel()
+
+    def _purge_expired(self, now):
+        cutoff = now - self._window
+        expired = [key for key, record in self._index.items() if record.created_at < cutoff]
+        for key in expired:
+            del self._index[key]
+        self._last_purge = now
+
+submission_dedup = SubmissionDeduplicator(SUBMISSION_DEDUP_WINDOW)
+
+# --- Admission Control ---
+
+AI_MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", "8"))  # AI calls running at once
+AI_MAX_QUEUED = int(os.getenv("AI_MAX_QUEUED", "40"))  # submissions allowed to wait for a slot
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "90"))  # seconds a submission may wait
+AI_REQUEST_DEADLINE = float(os.getenv("AI_REQUEST_DEADLINE", "120"))  # seconds for the AI call incl. retries
+
+class AdmissionRejected(Exception):
+    """Raised when a submission cannot get an AI slot (queue full or waited too long)."""
+
+class AdmissionController:
+    """
+    Limit how many AI calls run at once and how many submissions may wait.
+    Waiting submissions are served in arrival order. Used only from the event loop thread.
+    """
+
+    def __init__(self, max_concurrent, max_queued, queue_timeout):
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout
+        self._active = 0
+        self._waiting = collections.OrderedDict()  # ticket -> future resolved when a slot is handed over
+        self._avg_service_time = 20.0  # seconds, moving average of finished AI calls
+
+    def position(self, ticket):
+        """1-based position of a ticket in the waiting queue, or None"""
+        for index, waiting_ticket in enumerate(self._waiting, start=1):
+            if waiting_ticket == ticket:
+                return index
+        return None
+
+    def status(self, ticket=None):
+        position = self.position(ticket) if ticket else None
+        ahead = position if position else len(self._waiting) + 1
+        estimated_wait = 0
+        if position or self._active >= self._max_concurrent:
+            estimated_wait = int(self._avg_service_time * ahead / self._max_concurrent) + 1
+        return {
+            "position": position,
+            "queued": len(self._waiting),
+            "active": self._active,
+            "estimated_wait": estimated_wait
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self, ticket):
+        """Wait for an AI slot; raises AdmissionRejected if the queue is full or the wait times out"""
+        if self._active < self._max_concurrent and not self._waiting:
+            self._active += 1
+        else:
+            if len(self._waiting) >= self._max_queued:
+                raise AdmissionRejected("queue full")
+
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[ticket] = future
+            try:
+                await asyncio.wait_for(future, self._queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                self._waiting.pop(ticket, None)
+                # The slot may have been handed over just as we gave up
+                if future.done() and not future.cancelled():
+                    self._release()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise AdmissionRejected("queue timeout")
+                raise
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    def _release(self):
+        """Hand the slot to the next waiting submission, or free it"""
+        while self._waiting:
+            _, future = self._waiting.popitem(last=False)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+ai_admission = AdmissionController(AI_MAX_CONCURRENT, AI_MAX_QUEUED, AI_QUEUE_TIMEOUT)
+
+def build_retry_form(quiz_token, answers):
+    """Form that sends the same session token and answers to /submit again"""
+    fields = [f'<input type="hidden" name="quiz_token" value="{html.escape(quiz_token)}">']
+    for q_id, value in answers.items():
+        fields.append(f'<input type="hidden" name="q_{html.escape(q_id)}" value="{html.escape(value)}">')
+    return (
+        '<form action="/submit" method="post">'
+        + "".join(fields)
+        + '<button type="submit">Gửi lại bài làm ↩️</button>'
+        "</form>"
+    )
+
+def render_result_message(request, message, status_code=200, headers=None):
+    """Render the result page with a short notice instead of AI advice"""
+    return templates.TemplateResponse("result.html", {
+        "request": request,
+        "advice": message,
+        "version": int(time.time())
+    }, status_code=status_code, headers=headers)
+
 # --- Routes ---
 
 @app.get("/", response_class=HTMLResponse)
@@ -564,7 +1310,7 @@ async def start_quiz(request: Request):
     else:
         selected_questions = all_questions
     
-    # Pass student info to the quiz page - Force string conversion
+    # Keep student info on the server - Force string conversion
     student_info = {
         "student_name": str(student_name) if student_name else "",
         "student_phone": str(student_phone) if student_phone else "",
@@ -573,48 +1319,132 @@ async def start_quiz(request: Request):
         "student_school": str(student_school) if student_school else "",
         "student_cccd": str(student_cccd) if student_cccd else ""
     }
+    quiz_token = await asyncio.to_thread(quiz_sessions.create, selected_questions, student_info)
 
     return templates.TemplateResponse("index.html", {
         "request": request,
         "questions": selected_questions,
-        "student_info": student_info,
+        "quiz_token": quiz_token,
         "version": int(time.time())
     })
 
 @app.post("/submit", response_class=HTMLResponse)
 async def submit_quiz(request: Request):
     form_data = await request.form()
-    
-    student_name = form_data.get("student_name", "")
-    print(f"DEBUG: Submit received for '{student_name}'. Form keys: {list(form_data.keys())}")
-    
-    # Reconstruct the questions/answers mapping
-    # Since we don't have the question text in the form keys (only IDs like q_1),
-    # we need to look up the text.
-    # To do this efficiently, let's load all questions and create a map.
-    
-    all_questions = await asyncio.to_thread(load_questions)
-    question_map = {str(q['id']): q['content'] for q in all_questions}
-    
-    answers_text = ""
-    for key, value in form_data.items():
-        if key.startswith("q_"):
-            q_id = key.replace("q_", "")
-            if q_id in question_map:
-                q_text = question_map[q_id]
-                answers_text += f"- {q_text}: {value}\n"
-    
+
+    session = await asyncio.to_thread(quiz_sessions.get, form_data.get("quiz_token", ""))
+    if session is None:
+        return render_result_message(
+            request,
+            "⚠️ Phiên làm bài đã hết hạn hoặc không hợp lệ. Vui lòng quay lại trang chủ và làm lại bài trắc nghiệm."
+        )
+
+    student_info = session.student_info
+    print(f"DEBUG: Submit received for '{student_info['student_name']}'. Form keys: {list(form_data.keys())}")
+
+    # Answers are matched against the questions stored in the session
+    answers_text = session.build_answers_text(form_data)
+
     if not answers_text:
+        return render_result_message(
+            request,
+            "⚠️ Bạn chưa trả lời câu hỏi nào. Vui lòng quay lại và hoàn thành bài trắc nghiệm."
+        )
+
+    # Return the earlier result if this student already sent the same answers.
+    # find() and begin() must run without an await in between so a double-click
+    # always waits on the first submission.
+    dedup_keys = submission_dedup.keys_for(session.session_id, student_info, session.question_ids, form_data)
+    previous = submission_dedup.find(dedup_keys)
+    if previous is None:
+        record = submission_dedup.begin(dedup_keys)
+    else:
+        print(f"DEBUG: Duplicate submission for '{student_info['student_name']}', reusing earlier result")
+        advice_html = await previous.wait()
+        if advice_html is None:
+            return render_result_message(
+                request,
+                "⚠️ Bài làm trước đó của bạn chưa xử lý xong. Vui lòng thử lại sau ít phút."
+            )
         return templates.TemplateResponse("result.html", {
             "request": request,
-            "advice": "⚠️ Bạn chưa trả lời câu hỏi nào. Vui lòng quay lại và hoàn thành bài trắc nghiệm.",
+            "advice": advice_html,
             "version": int(time.time())
         })
 
+    try:
+        submitted = await asyncio.to_thread(quiz_sessions.mark_submitted, session)
+    except BaseException:
+        submission_dedup.discard(record)
+        raise
+    if not submitted:
+        submission_dedup.discard(record)
+        return render_result_message(
+            request,
+            "⚠️ Bài trắc nghiệm này đã được gửi. Vui lòng chờ kết quả hoặc quay lại trang chủ để làm bài mới."
+        )
+
+    try:
+        async with ai_admission.slot(session.session_id):
+            deadline = time.monotonic() + AI_REQUEST_DEADLINE
+            advice_html, result_source = await analyze_submission({**student_info, 'quiz_started_at': session.created_at},
+                                                             answers_text, deadline, session.answers(form_data))
+    except AdmissionRejected as e:
+        print(f"⚠️ Submission for '{student_info['student_name']}' turned away: {e}")
+        submission_dedup.discard(record)
+        await asyncio.to_thread(quiz_sessions.reopen, session)
+        return render_result_message(
+            request,
+            "⏳ Hệ thống đang có quá nhiều bạn cùng nộp bài. Câu trả lời của bạn vẫn được giữ nguyên, "
+            "vui lòng đợi khoảng 1 phút rồi bấm nút bên dưới để gửi lại.<br><br>"
+            + build_retry_form(form_data["quiz_token"], session.answers(form_data)),
+            status_code=503,
+            headers={"Retry-After": "60"}
+        )
+    except BaseException:
+        submission_dedup.discard(record)
+        raise
+    # Errors are shown once but not reused for later duplicates, and the student may submit again.
+    # A local fallback result is saved like an AI result, so it is final.
+    is_error = result_source == "error"
+    submission_dedup.complete(record, advice_html, keep=not is_error)
+    if is_error:
+        await asyncio.to_thread(quiz_sessions.reopen, session)
+
+    return templates.TemplateResponse("result.html", {
+        "request": request,
+        "advice": advice_html,
+        "version": int(time.time())
+    })
+
+async def analyze_submission(student_info, answers_text, deadline=None, answers=None):
+    """
+    Ask the AI for advice, extract the majors and save the student to Google Sheets.
+    answers ({question_id: option_key}) feeds the local scoring used as hint and fallback.
+    Returns (advice_html, result_source): "ai", "local" (fallback from the local scores)
+    or "error". Error results are shown but not saved.
+    """
     print(f"--- User Answers ---\n{answers_text}\n--------------------")
 
+    top_majors = []
+    if answers:
+        engine = await asyncio.to_thread(get_scoring_engine)
+        top_majors = engine.top_majors(answers)
+        print(f"DEBUG: Local top majors: {top_majors}")
+
+    hint = None
+    if LOCAL_SCORING_HINT and top_majors:
+        hint = "Các ngành có điểm phù hợp cao nhất: " + ", ".join(name for name, _ in top_majors)
+
     # Generate advice
-    advice_markdown = await generate_ai_advice(answers_text)
+    advice_markdown = await generate_ai_advice(answers_text, deadline, hint)
+    result_source = "ai"
+    if advice_markdown.startswith("⚠️"):
+        result_source = "error"
+        if top_majors:
+            print(f"⚠️ AI unavailable, using local scoring result. AI error: {advice_markdown}")
+            advice_markdown = build_fallback_advice(top_majors)
+            result_source = "local"
     
     # Save full AI response for debugging
     print(f"\n{'='*80}\nFULL AI RESPONSE:\n{'='*80}\n{advice_markdown}\n{'='*80}\n")
@@ -732,31 +1562,82 @@ async def submit_quiz(request: Request):
 
     # Extract student info
     student_data = {
-        'student_name': str(form_data.get('student_name', '')),
-        'student_phone': str(form_data.get('student_phone', '')),
-        'student_email': str(form_data.get('student_email', '')),
-        'student_province': str(form_data.get('student_province', '')),
-        'student_school': str(form_data.get('student_school', '')),
-        'student_cccd': str(form_data.get('student_cccd', '')),
+        **student_info,
         'predicted_major': predicted_major,
         'sub_major_1': sub_major_1,
         'sub_major_2': sub_major_2,
-        'career_advice': advice_markdown
+        'career_advice': advice_markdown,
+        'result_source': result_source
     }
     
     print(f"DEBUG: Processing quiz for {student_data['student_name']} from {student_data['student_school']}")
     
-    # Save to Google Sheet (run in background)
-    asyncio.create_task(save_student_info(student_data))
+    # Save to Google Sheet and local analytics (run in background).
+    # Error results are not saved: the student can submit again and would get a second row,
+    # and "Không xác định" would be counted as a major in the stats.
+    if result_source != "error":
+        asyncio.create_task(save_student_info(student_data))
+        asyncio.create_task(save_analytics(student_data))
 
     # Convert Markdown to HTML for display
     advice_html = await asyncio.to_thread(markdown.markdown, advice_markdown)
-    
-    return templates.TemplateResponse("result.html", {
-        "request": request,
-        "advice": advice_html,
-        "version": int(time.time())
-    })
+
+    return advice_html, result_source
+
+@app.get("/queue-status")
+async def queue_status(request: Request):
+    """Queue position and estimated wait for the loading screen (token in the X-Quiz-Token header)"""
+    token = request.headers.get("X-Quiz-Token", "")
+    session = await asyncio.to_thread(quiz_sessions.get, token) if token else None
+    return JSONResponse(ai_admission.status(session.session_id if session else None))
+
+def require_admin(request: Request):
+    """Check the admin token from the X-Admin-Token header (never the URL, it ends up in access logs)"""
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if not analytics_store:
+        raise HTTPException(status_code=503, detail="Analytics store unavailable")
+
+@app.get("/admin/stats")
+async def admin_stats(request: Request, by: str = "all"):
+    """Result counts per major, grouped by all/day/province/school/team"""
+    require_admin(request)
+    if by not in ANALYTICS_GROUPS:
+        raise HTTPException(status_code=400, detail=f"'by' must be one of {', '.join(ANALYTICS_GROUPS)}")
+    rows = await asyncio.to_thread(analytics_store.counts, by)
+    return JSONResponse({"by": by, "rows": rows})
+
+@app.get("/admin/export")
+async def admin_export(request: Request, format: str = "csv", since: str = "", until: str = "",
+                       province: str = "", school: str = "", team: str = "", major: str = ""):
+    """Download stored results as CSV (streamed) or Parquet"""
+    require_admin(request)
+    filters = {"since": since, "until": until, "student_province": province,
+               "student_school": school, "team": team, "predicted_major": major}
+    try:
+        analytics_store.where_clause(filters)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="'since' and 'until' must be YYYY-MM-DD")
+
+    filename = f"quiz_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    if format == "csv":
+        return StreamingResponse(
+            analytics_store.iter_csv(filters),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.csv"'}
+        )
+    if format == "parquet":
+        try:
+            content = await asyncio.to_thread(analytics_store.to_parquet, filters)
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed on the server")
+        return Response(
+            content,
+            media_type="application/vnd.apache.parquet",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.parquet"'}
+        )
+    raise HTTPException(status_code=400, detail="'format' must be csv or parquet")
 
 @app.get("/favicon.ico")
 async def favicon():